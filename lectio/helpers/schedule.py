@@ -1,11 +1,34 @@
 import re
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from datetime import datetime, timedelta
-from typing import TYPE_CHECKING, List
-from bs4 import BeautifulSoup
+from typing import TYPE_CHECKING, Iterator, List, Tuple
+from urllib.parse import quote
+from bs4 import SoupStrainer
+
+from .soup import make_soup
 
 if TYPE_CHECKING:
+    from requests import Response
     from ..lectio import Lectio
 
+_LECTIO_ORIGIN = "https://www.lectio.dk"
+
+# Static part of the SkemaAvanceret.aspx query string
+_SCHEDULE_QUERY = "type=ShowListAll&dagsbemaerk=0"
+
+_TABLE_STRAINER = SoupStrainer("table", class_="list texttop lf-grid")
+
+_TITLE_GUARD_RE = re.compile(r'^\d{1,2}/\d{1,2}-\d{4} \d{2}:\d{2}')
+# Module info field labels and the Module attribute they map to
+_FIELDS = {
+    "Hold": "subject",
+    "Lærer": "teacher",
+    "Lærere": "teacher",
+    "Lokale": "room",
+    "Lokaler": "room",
+}
+
 
 class Module:
     """Lectio module object
@@ -27,16 +50,21 @@ class Module:
         url (str|None): Url for more info for the module
     """
 
-    def __init__(self, **kwargs) -> None:
-        self.title = kwargs.get("title")
-        self.subject = kwargs.get("subject")
-        self.teacher = kwargs.get("teacher")
-        self.room = kwargs.get("room")
-        self.extra_info = kwargs.get("extra_info")
-        self.start_time = kwargs.get("start_time")
-        self.end_time = kwargs.get("end_time")
-        self.status = kwargs.get("status")
-        self.url = kwargs.get("url")
+    __slots__ = ("title", "subject", "teacher", "room", "extra_info",
+                 "start_time", "end_time", "status", "url")
+
+    def __init__(self, title: str = None, subject: str = None, teacher: str = None, room: str = None,
+                 extra_info: str = None, start_time: datetime = None, end_time: datetime = None,
+                 status: int = None, url: str = None) -> None:
+        self.title = title
+        self.subject = subject
+        self.teacher = teacher
+        self.room = room
+        self.extra_info = extra_info
+        self.start_time = start_time
+        self.end_time = end_time
+        self.status = status
+        self.url = url
 
     def __repr__(self) -> str:
         return f"Module({self.subject}, {self.start_time}, {self.end_time})"
@@ -66,114 +94,201 @@ def get_schedule(lectio: 'Lectio', params: List[str], start_date: datetime, end_
         strip_time (bool): Whether to remove hours, minutes and seconds from date info, also adds 1 day to end time.
             Basically just allows you to put in a random time of two days, and still get all modules from all the days including start and end date.
 
+    Note:
+        When the lectio object was created with a ``schedule_cache_ttl``, parsed schedules are reused
+        for that long, so repeated calls with the same parameters and time range don't hit Lectio again.
+        Use :meth:`lectio.Lectio.clear_schedule_cache` to force a refetch.
+        Each call returns its own copies of the modules.
+
     Returns:
         List[:class:`lectio.Module`]: List containing all modules in specified time range.
     """
 
-    replacetime = {}
+    query = _schedule_query(params, start_date, end_date, strip_time)
+
+    return [copy(module) for module in lectio._cached_schedule(query)]
+
+
+def iter_schedule(lectio: 'Lectio', params: List[str], start_date: datetime, end_date: datetime, strip_time: bool = True) -> Iterator[Module]:
+    """Iterate over lectio schedule for current or specific week.
+
+    Like :func:`get_schedule`, but modules are parsed one at a time as they are consumed,
+    so breaking out early skips parsing the rest. The schedule cache is not used.
+
+    Parameters:
+        lectio (:class:`lectio.Lectio`): Base lectio object
+        params (list): List of get parameters to add to request
+        start_date (:class:`datetime.datetime`): Start date
+        end_date (:class:`datetime.datetime`): End date
+        strip_time (bool): See :func:`get_schedule`
+
+    Yields:
+        :class:`lectio.Module`: Modules in specified time range.
+    """
+
+    query = _schedule_query(params, start_date, end_date, strip_time)
+
+    yield from _iter_modules(lectio._request(f"SkemaAvanceret.aspx?{query}"))
+
+
+def fetch_schedule(lectio: 'Lectio', query: str) -> Tuple[Module, ...]:
+    """Fetch and parse a schedule, bypassing the schedule cache.
+
+    Parameters:
+        lectio (:class:`lectio.Lectio`): Base lectio object
+        query (str): Query string for ``SkemaAvanceret.aspx``
+
+    Returns:
+        Tuple[:class:`lectio.Module`]: All modules in the schedule
+    """
+
+    return tuple(_iter_modules(lectio._request(f"SkemaAvanceret.aspx?{query}")))
+
+
+def _schedule_query(params: List[str], start_date: datetime, end_date: datetime, strip_time: bool) -> str:
     if strip_time:
-        end_date = end_date + timedelta(days=1)
-        replacetime = {
-            "hour": 0,
-            "minute": 0,
-            "second": 0,
-        }
+        start_date = _midnight_isoformat(start_date)
+        end_date = _midnight_isoformat(end_date + timedelta(days=1))
+    else:
+        start_date = start_date.isoformat(timespec="seconds")
+        end_date = end_date.isoformat(timespec="seconds")
 
-    start_date = start_date.replace(
-        **replacetime, microsecond=0).isoformat()
-    end_date = end_date.replace(**replacetime, microsecond=0).isoformat()
+    # Timezone offsets (``+01:00``) have to be escaped
+    query = f"{_SCHEDULE_QUERY}&starttime={quote(start_date, safe=':')}&endtime={quote(end_date, safe=':')}"
+    if params:
+        query += "&" + "&".join(params)
 
-    params = "&".join([
-        "type=ShowListAll",
-        f"starttime={start_date}",
-        f"endtime={end_date}",
-        "dagsbemaerk=0",
-        *params
-    ])
+    return query
 
-    schedule_request = lectio._request(f"SkemaAvanceret.aspx?{params}")
 
-    soup = BeautifulSoup(schedule_request.text, 'html.parser')
+def _midnight_isoformat(value: datetime) -> str:
+    # Same as ``value.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()``
+    if value.tzinfo is not None:
+        return value.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
 
-    module_table = soup.find(
-        "table", class_="list texttop lf-grid")
+    return f"{value.year:04d}-{value.month:02d}-{value.day:02d}T00:00:00"
 
-    if not module_table:
-        return []
 
-    # Not a good way of checking if there are no modules, but it works
-    if module_table.find("div", {"class": "noRecord"}):
-        return []
+def _iter_modules(schedule_request: 'Response') -> Iterator[Module]:
+    # Only the schedule table is built into a tree
+    soup = make_soup(schedule_request, _TABLE_STRAINER)
+
+    module_table = soup.table
+
+    if not module_table:
+        return
 
-    modules = module_table.findChildren('tr', class_=None)
+    # Module rows are direct children of the table or of its sections,
+    # so there's no need to search nested tags (or nested tables)
+    sections = [module_table, *module_table.find_all(["thead", "tbody", "tfoot"], recursive=False)]
+    modules = (row for section in sections for row in section.find_all('tr', class_=None, recursive=False))
 
-    schedule = []
     for module in modules:
-        a = module.findChild('a')
-        module = parse_additionalinfo(
-            a.attrs.get('data-additionalinfo'))
+        a = module.a
+
+        # Rows without module info, like the "noRecord" row of an empty schedule, are skipped
+        # here instead of searching the whole table for them up front
+        info = a.get('data-additionalinfo') if a is not None else None
+        if info is None:
+            continue
+
+        module = parse_additionalinfo(info)
 
         # Add href to module
-        href = a.attrs.get('href')
+        href = a.get('href')
         if href:
-            module.url = f"https://www.lectio.dk{href}"
+            module.url = _LECTIO_ORIGIN + href
+
+        yield module
 
-        schedule.append(module)
 
-    return schedule
+def get_schedules(lectio: 'Lectio', param_sets: List[List[str]], start_date: datetime, end_date: datetime, strip_time: bool = True, max_workers: int = 8) -> List[List[Module]]:
+    """Get multiple lectio schedules for the same time range concurrently.
+
+    Fetches the schedule for each set of parameters (e.g. one per user) in a thread pool,
+    so the requests share the session's connection pool instead of waiting on each other.
+
+    Parameters:
+        lectio (:class:`lectio.Lectio`): Base lectio object
+        param_sets (list): List of parameter lists, see :func:`get_schedule`
+        start_date (:class:`datetime.datetime`): Start date
+        end_date (:class:`datetime.datetime`): End date
+        strip_time (bool): See :func:`get_schedule`
+        max_workers (int): Maximum number of concurrent requests
+
+    Returns:
+        List[List[:class:`lectio.Module`]]: One schedule per parameter set, in the same order as ``param_sets``.
+    """
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            lambda params: get_schedule(
+                lectio, params, start_date, end_date, strip_time),
+            param_sets
+        ))
+
+
+def _parse_datetime(value: str) -> datetime:
+    # Equivalent to ``datetime.strptime(value, "%d/%m-%Y %H:%M")``, without
+    # re-parsing the format string for every module.
+    date, _, time = value.partition(" ")
+    day, _, date = date.partition("/")
+    month, _, year = date.partition("-")
+    hour, _, minute = time.partition(":")
+
+    return datetime(int(year), int(month), int(day), int(hour), int(minute))
 
 
 def parse_additionalinfo(info: str) -> Module:
     module = Module()
 
-    info_list = info.split('\n')
+    # The header is at most 7 lines (status, title, time, subject, teacher, room and a blank line),
+    # anything after that belongs to extra_info and is kept in one piece
+    info_list = info.split('\n', 7)
+    i = 0  # Index of the next unparsed line
 
     # Parse module status
-    if info_list[0] == 'Ændret!':
+    if info_list[i] == 'Ændret!':
         module.status = 1
-        info_list.pop(0)
-    elif info_list[0] == 'Aflyst!':
+        i += 1
+    elif info_list[i] == 'Aflyst!':
         module.status = 2
-        info_list.pop(0)
+        i += 1
     else:
         module.status = 0
 
     # Parse title
-    if not re.match(r'^[0-9]{1,2}\/[0-9]{1,2}-[0-9]{4} [0-9]{2}:[0-9]{2}', info_list[0]):
-        module.title = info_list[0]
-        info_list.pop(0)
+    # Timestamps always start with a digit, so only titles that do too need the regex
+    first = info_list[i]
+    if not first[:1].isdigit() or not _TITLE_GUARD_RE.match(first):
+        module.title = first
+        i += 1
 
     # Parse time
-    times = info_list[0].split(" til ")
-    info_list.pop(0)
-    module.start_time = datetime.strptime(times[0], "%d/%m-%Y %H:%M")
+    times = info_list[i].split(" til ")
+    i += 1
+    module.start_time = _parse_datetime(times[0])
     if len(times[1]) == 5:
-        module.end_time = datetime.strptime(
-            times[0][:-5] + times[1], "%d/%m-%Y %H:%M")
+        # Same day, reuse the already parsed date
+        hour, _, minute = times[1].partition(":")
+        module.end_time = module.start_time.replace(
+            hour=int(hour), minute=int(minute))
     else:
-        module.end_time = datetime.strptime(times[1], "%d/%m-%Y %H:%M")
-
-    # Parse subject(s)
-    subject = re.search(r"Hold: (.*)", info)
-    if subject:
-        info_list.pop(0)
-        module.subject = subject[1]
-
-    # Parse teacher(s)
-    teacher = re.search(r"Lærere?: (.*)", info)
-    if teacher:
-        info_list.pop(0)
-        module.teacher = teacher[1]
-
-    # Parse room(s)
-    room = re.search(r"Lokaler?: (.*)", info)
-    if room:
-        info_list.pop(0)
-        module.room = room[1]
+        module.end_time = _parse_datetime(times[1])
+
+    # Parse subject(s), teacher(s) and room(s), which directly follow the time
+    while i < len(info_list):
+        label, sep, value = info_list[i].partition(": ")
+
+        field = _FIELDS.get(label)
+        if not sep or field is None:
+            break
+
+        setattr(module, field, value)
+        i += 1
 
     # Put any additional info into extra_info
-    if info_list:
-        info_list.pop(0)
-        module.extra_info = "\n".join(info_list)
+    if i < len(info_list):
+        module.extra_info = "\n".join(info_list[i + 1:])
 
     return module
@@ -0,0 +1,45 @@
+from typing import TYPE_CHECKING
+from bs4 import BeautifulSoup, SoupStrainer
+from lxml import etree, html
+
+if TYPE_CHECKING:
+    from requests import Response
+
+
+def make_soup(response: 'Response', parse_only: SoupStrainer = None) -> BeautifulSoup:
+    """Parse a Lectio response with lxml.
+
+    The raw body is handed to the parser together with the charset from the response headers,
+    so it is decoded once, and without any encoding detection.
+
+    Parameters:
+        response (:class:`requests.Response`): Response to parse
+        parse_only (:class:`bs4.SoupStrainer`): Optional strainer limiting which tags are parsed
+
+    Returns:
+        :class:`bs4.BeautifulSoup`: Parsed document
+    """
+
+    return BeautifulSoup(response.content, "lxml", from_encoding=response.encoding or "utf-8",
+                         parse_only=parse_only)
+
+
+def make_tree(response: 'Response') -> 'html.HtmlElement':
+    """Parse a Lectio response into a plain lxml tree.
+
+    Cheaper than :func:`make_soup` for pages where only a few nodes are read with XPath.
+
+    Parameters:
+        response (:class:`requests.Response`): Response to parse
+
+    Returns:
+        :class:`lxml.html.HtmlElement`: Root element of the parsed document
+    """
+
+    parser = html.HTMLParser(encoding=response.encoding or "utf-8")
+
+    try:
+        return html.document_fromstring(response.content, parser=parser)
+    except etree.ParserError:
+        # Empty body, e.g. from a failed request, gives an empty document like BeautifulSoup does
+        return html.Element("html")
@@ -1,12 +1,53 @@
 import re
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Dict, List, Tuple
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import SoupStrainer
 
 from . import exceptions
 
+from .helpers.schedule import Module, fetch_schedule
+from .helpers.soup import make_soup
 from .models.user import Me, User, UserType
 from .models.school import School
 
+# Fields of the login form that never change
+_LOGIN_FORM = {
+    "time": 0,
+    "__EVENTTARGET": "m$Content$submitbtn2",
+    "__EVENTARGUMENT": "",
+    "__SCROLLPOSITION": "",
+    "__VIEWSTATEY_KEY": "",
+    "__VIEWSTATE": "",
+}
+
+_LOGIN_FORM_STRAINER = SoupStrainer(
+    "input", attrs={"name": ["__VIEWSTATEX", "__EVENTVALIDATION"]})
+_STARTURL_STRAINER = SoupStrainer(
+    "meta", attrs={"name": "msapplication-starturl"})
+
+_LOGIN_FORM_RE = re.compile(
+    rb'name="(__VIEWSTATEX|__EVENTVALIDATION)"[^>]*value="([^"]*)"')
+# Maximum number of cached schedules, the least recently used is dropped first
+_SCHEDULE_CACHE_SIZE = 128
+
+_USER_ID_RE = re.compile(r'id=(\d+)$')
+_STARTURL_RE = re.compile(
+    rb'name="msapplication-starturl"\s+content="[^"]*id=(\d+)"')
+
+
+def _make_adapter() -> HTTPAdapter:
+    # Large enough for the thread pool helpers, retrying on Lectio's occasional server errors
+    return HTTPAdapter(
+        pool_connections=4, pool_maxsize=64,
+        max_retries=Retry(total=3, backoff_factor=0.2,
+                          status_forcelist=(500, 502, 503, 504), raise_on_status=False))
+
 
 class Lectio:
     """The main Lectio class.
@@ -22,16 +63,43 @@ class Lectio:
                 https://www.lectio.dk/lectio/123/login.aspx
 
             Here, the ``123`` would be my institution id.
-    """
 
-    __school: School = None
-    __me: Me = None
+        schedule_cache_ttl (float): Seconds a fetched schedule is reused for the same user and time range.
 
-    def __init__(self, inst_id: int) -> None:
+            Disabled (``0``) by default, so every schedule lookup gets fresh data from Lectio.
+            See :meth:`clear_schedule_cache`.
+
+        adapter (:class:`requests.adapters.HTTPAdapter`): Optional adapter used for the connections to Lectio.
+
+            By default each Lectio object gets its own pooled adapter, which retries on server errors.
+            Pass the same adapter to several Lectio objects to let them reuse each other's connections.
+            Cookies live on each object's own session, so logins stay separate.
+    """
+
+    def __init__(self, inst_id: int, adapter: HTTPAdapter = None, schedule_cache_ttl: float = 0) -> None:
         self.__CREDS = []
+        self.__school: School = None
+        self.__me: Me = None
         self.__session = requests.Session()
+        self.__session.mount("https://", adapter or _make_adapter())
+
+        # Parsed schedules keyed by query string, as ``(fetch time, future modules)``,
+        # in least to most recently used order
+        self.__schedule_cache = OrderedDict()
+        self.__schedule_cache_lock = Lock()
+        self.__schedule_cache_ttl = schedule_cache_ttl
+
+        # Serialises silent re-logins from concurrent requests, the counter
+        # tells a waiting request whether another one already logged in again
+        self.__login_lock = Lock()
+        self.__login_count = 0
 
         self.inst_id = inst_id
+        self.__base_url = f"https://www.lectio.dk/lectio/{inst_id}"
+        self.__login_url = f"{self.__base_url}/login.aspx"
+
+        # Part of the url Lectio redirects to when the session has expired
+        self.__login_marker = f"{inst_id}/login.aspx?prevurl="
 
     def authenticate(self, username: str, password: str, save_creds: bool = True) -> bool:
         """Authenticates you on Lectio.
@@ -47,6 +115,9 @@ class Lectio:
             password (str): Lectio password for the given institution id.
             save_creds (bool): Whether the credentials should be saved in the object (useful for auto relogin on logout)
 
+        Returns:
+            bool: ``True`` when authenticated
+
         Raises:
             :class:`exceptions.IncorrectCredentialsError`: When incorrect credentials passed
             :class:`exceptions.InstitutionDoesNotExistError`: When the institution id passed on creation of object is invalid
@@ -72,9 +143,9 @@ class Lectio:
             self.__CREDS = [username, password]
 
         # Call the actual authentication method
-        self._authenticate(username, password)
+        return self._authenticate(username, password)
 
-    def _authenticate(self, username: str = None, password: str = None):
+    def _authenticate(self, username: str = None, password: str = None) -> bool:
         if username is None or password is None:
             if len(self.__CREDS) != 2:
                 raise exceptions.UnauthenticatedError(
@@ -84,25 +155,29 @@ class Lectio:
 
         self.log_out()  # Clear session
 
-        URL = f"https://www.lectio.dk/lectio/{self.inst_id}/login.aspx"
+        URL = self.__login_url
 
         login_page = self.__session.get(URL)
 
         if 'fejlhandled.aspx?title=Skolen+eksisterer+ikke' in login_page.url:
             raise exceptions.InstitutionDoesNotExistError(
-                f"The institution with the id '{self._INST_ID}' does not exist!")
+                f"The institution with the id '{self.inst_id}' does not exist!")
 
-        parser = BeautifulSoup(login_page.text, "html.parser")
+        # Read the two hidden form values straight from the page,
+        # only build a tree if the markup is different from what we expect
+        form = {name.decode(): value.decode()
+                for name, value in _LOGIN_FORM_RE.findall(login_page.content)}
+        if len(form) != 2:
+            parser = make_soup(login_page, _LOGIN_FORM_STRAINER)
+
+            form = {
+                "__VIEWSTATEX": parser.find(attrs={"name": "__VIEWSTATEX"})["value"],
+                "__EVENTVALIDATION": parser.find(attrs={"name": "__EVENTVALIDATION"})["value"],
+            }
 
         r = self.__session.post(URL, data={
-            "time": 0,
-            "__EVENTTARGET": "m$Content$submitbtn2",
-            "__EVENTARGUMENT": "",
-            "__SCROLLPOSITION": "",
-            "__VIEWSTATEX": parser.find(attrs={"name": "__VIEWSTATEX"})["value"],
-            "__VIEWSTATEY_KEY": "",
-            "__VIEWSTATE": "",
-            "__EVENTVALIDATION": parser.find(attrs={"name": "__EVENTVALIDATION"})["value"],
+            **_LOGIN_FORM,
+            **form,
             "m$Content$username": username,
             "m$Content$password": password
         })
@@ -112,6 +187,10 @@ class Lectio:
             raise exceptions.IncorrectCredentialsError(
                 "Incorrect credentials provided!")
 
+        self.__login_count += 1
+
+        return True
+
     def school(self) -> School:
         """Returns a :class:`lectio.models.school.School` object for the given institution id.
 
@@ -119,10 +198,11 @@ class Lectio:
             :class:`lectio.models.school.School`: The school object for the authenticated user.
         """
 
-        if self.__school is None:
-            self.__school = School(self)
+        school = self.__school
+        if school is None:
+            school = self.__school = School(self)
 
-        return self.__school
+        return school
 
     def me(self) -> Me:
         """Gets the authenticated user
@@ -131,40 +211,128 @@ class Lectio:
             :class:`lectio.models.user.Me`: Own user object
         """
 
-        if self.__me is None:
+        me = self.__me
+        if me is None:
             r = self._request("forside.aspx")
 
-            soup = BeautifulSoup(r.text, 'html.parser')
+            # Read the user id straight from the meta tag,
+            # only build a tree if the markup is different from what we expect
+            match = _STARTURL_RE.search(r.content)
+            if match:
+                user_id = match[1].decode()
+            else:
+                soup = make_soup(r, _STARTURL_STRAINER)
 
-            content = soup.find(
-                'meta', {'name': 'msapplication-starturl'}).attrs.get('content')
+                content = soup.find('meta').attrs.get('content')
 
-            user_id = re.match(r'.*id=([0-9]+)$', content)[1]
+                user_id = _USER_ID_RE.search(content)[1]
 
             # TODO; Add support for teachers
-            self.__me = Me(self, user_id, UserType.STUDENT)
+            me = self.__me = Me(self, user_id, UserType.STUDENT)
 
-        return self.__me
+        return me
+
+    def prefetch(self, endpoints: List[str], max_workers: int = 8) -> Dict[str, requests.Response]:
+        """Requests multiple Lectio pages concurrently
+
+        Useful when you need several independent pages at once,
+        as the total time is roughly that of the slowest request instead of the sum of all of them.
+
+        Args:
+            endpoints (list(str)): Pages relative to the institution, e.g. ``"forside.aspx"``. Duplicates are only requested once.
+            max_workers (int): Maximum number of concurrent requests
+
+        Returns:
+            dict(str, :class:`requests.Response`): Responses keyed by endpoint
+        """
+
+        endpoints = list(dict.fromkeys(endpoints))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(endpoints, executor.map(self._request, endpoints)))
 
     def _request(self, url: str, method: str = "GET", **kwargs) -> requests.Response:
+        login_count = self.__login_count
+
         r = self.__session.request(
-            method, f"https://www.lectio.dk/lectio/{str(self.inst_id)}/{url}", **kwargs)
-
-        if f"{self.inst_id}/login.aspx?prevurl=" in r.url:
-            if not self._authenticate():
-                raise exceptions.UnauthenticatedError("Unauthenticated")
-            r = self.__session.get(
-                f"https://www.lectio.dk/lectio/{str(self.inst_id)}/{url}")
-            if f"{self.inst_id}/login.aspx?prevurl=" in r.url:
+            method, f"{self.__base_url}/{url}", **kwargs)
+
+        # Lectio only ends up on the login page through a redirect,
+        # so the url only has to be checked when there was one
+        if r.history and self.__login_marker in r.url:
+            with self.__login_lock:
+                # Only log in again if no other request did while this one was waiting
+                if self.__login_count == login_count and not self._authenticate():
+                    raise exceptions.UnauthenticatedError("Unauthenticated")
+            r = self.__session.get(f"{self.__base_url}/{url}")
+            if r.history and self.__login_marker in r.url:
                 raise exceptions.IncorrectCredentialsError(
                     "Could not restore session, probably incorrect credentials")
 
         return r
 
+    def _cached_schedule(self, query: str) -> Tuple[Module, ...]:
+        if not self.__schedule_cache_ttl:
+            return fetch_schedule(self, query)
+
+        cache = self.__schedule_cache
+
+        with self.__schedule_cache_lock:
+            entry = cache.get(query)
+
+            # A schedule that is still being fetched is waited for instead of fetched again
+            if entry is not None and (not entry[1].done() or time.monotonic() - entry[0] <= self.__schedule_cache_ttl):
+                cache.move_to_end(query)
+                return_existing = True
+            else:
+                entry = (time.monotonic(), Future())
+                cache[query] = entry
+                cache.move_to_end(query)
+                if len(cache) > _SCHEDULE_CACHE_SIZE:
+                    cache.popitem(last=False)
+                return_existing = False
+
+        if return_existing:
+            return entry[1].result()
+
+        try:
+            modules = fetch_schedule(self, query)
+        except BaseException as e:
+            entry[1].set_exception(e)
+
+            # Failed fetches are not cached
+            with self.__schedule_cache_lock:
+                if cache.get(query) is entry:
+                    del cache[query]
+
+            raise
+
+        entry[1].set_result(modules)
+
+        return modules
+
     def log_out(self) -> None:
         """Clears entire session, thereby logging you out
 
+        Note:
+            Only the session cookies are cleared, open connections to Lectio are kept for reuse.
+
         Returns:
             None
         """
-        self.__session = requests.Session()
+        self.__session.cookies.clear()
+        self.__me = None
+        self.clear_schedule_cache()
+
+    def clear_schedule_cache(self) -> None:
+        """Clears cached schedules, so the next schedule lookup fetches fresh data from Lectio
+
+        Note:
+            This is done automatically when logging in or out.
+            Otherwise schedules are reused for ``schedule_cache_ttl`` seconds, when set.
+
+        Returns:
+            None
+        """
+        with self.__schedule_cache_lock:
+            self.__schedule_cache.clear()
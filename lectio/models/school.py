@@ -1,14 +1,36 @@
-from typing import TYPE_CHECKING, List
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, TypeVar
 import re
+import sys
+import time
 from urllib.parse import quote
 
+from bs4 import SoupStrainer
+from lxml import etree
+
 from .user import User, UserType
 from ..import exceptions
+from ..helpers.schedule import get_schedules
+from ..helpers.soup import make_soup, make_tree
 
 if TYPE_CHECKING:
+    from datetime import datetime
+    from ..helpers.schedule import Module
     from .. import Lectio
 
+_NAME_STRAINER = SoupStrainer("div", id="s_m_masterleftDiv")
+# First link of every entry in the first user list on FindSkema.aspx
+_LIST_LINKS_XPATH = etree.XPath(
+    "(//ul[@class='ls-columnlist mod-onechild'])[1]//li/descendant::a[1]")
+_TEACHER_NAME_XPATH = etree.XPath("string(node()[2])", smart_strings=False)
+_T = TypeVar("_T")
+
+# Seconds a fetched teacher or student list is reused, see :meth:`School.clear_cache`
+_LIST_CACHE_TTL = 5 * 60
+_STUDENT_RE = re.compile(r"(?P<name>.*) \((?P<class_name>.*?) \d+?\)")
+
 
 class School:
     """A school object.
@@ -25,15 +47,50 @@ class School:
 
     def __init__(self, lectio: 'Lectio') -> None:
         self._lectio = lectio
-        self.__populate()
+        self.__name = None
+        # Fetched user lists keyed by page, as ``(fetch time, fetched data)``
+        self.__list_cache = {}
 
     def __populate(self) -> None:
         r = self._lectio._request("forside.aspx")
 
-        soup = BeautifulSoup(r.text, 'html.parser')
+        soup = make_soup(r, parse_only=_NAME_STRAINER)
+
+        # First line of all the text in the div, which may span inline elements
+        name = soup.find("div", {"id": "s_m_masterleftDiv"}).text.strip()
+
+        self.__name = name.partition("\n")[0].replace("\r", "")
+
+    @property
+    def name(self) -> str:
+        """str: School name"""
+
+        if self.__name is None:
+            self.__populate()
+
+        return self.__name
+
+    def __cached(self, key: str, fetch: Callable[[], _T]) -> _T:
+        now = time.monotonic()
+
+        entry = self.__list_cache.get(key)
+        if entry is None or now - entry[0] > _LIST_CACHE_TTL:
+            entry = (now, fetch())
+            self.__list_cache[key] = entry
+
+        return entry[1]
+
+    def clear_cache(self) -> None:
+        """Clears cached teacher and student lists, so the next lookup fetches fresh data from Lectio
+
+        Note:
+            The lists are otherwise reused for 5 minutes.
+
+        Returns:
+            None
+        """
 
-        self.name = soup.find(
-            "div", {"id": "s_m_masterleftDiv"}).text.strip().split("\n")[0].replace("\r", "")
+        self.__list_cache.clear()
 
     def get_user_by_id(self, user_id: str, user_type: UserType = UserType.STUDENT, check: bool = True) -> User:
         """Gets a user by their id
@@ -55,7 +112,7 @@ class School:
             r = self._lectio._request(
                 f"SkemaNy.aspx?type={user_type}&{user_type}id={user_id}")
 
-            soup = BeautifulSoup(r.text, 'html.parser')
+            soup = make_soup(r)
 
             if soup.title.string.strip().startswith("Fejl - Lectio"):
                 raise exceptions.UserDoesNotExistError(
@@ -68,40 +125,67 @@ class School:
 
         Returns:
             list(:class:`lectio.models.user.User`): List of teachers
+
+        Note:
+            The list is cached for 5 minutes, see :meth:`clear_cache`.
         """
 
-        r = self._lectio._request("FindSkema.aspx?type=laerer&sortering=id")
+        teachers, _ = self.__cached("teachers", self.__fetch_teachers)
 
-        soup = BeautifulSoup(r.text, 'html.parser')
+        return list(teachers)
 
-        teachers = []
+    def __fetch_teachers(self) -> Tuple[List[User], Dict[str, User]]:
+        r = self._lectio._request("FindSkema.aspx?type=laerer&sortering=id")
 
-        # Container containing all teachers
-        lst = soup.find("ul", {"class": "ls-columnlist mod-onechild"})
+        tree = make_tree(r)
 
-        if lst is None:
-            return []
+        teachers = []
+        teachers_by_initials = {}
 
-        # Iterate and create user objects
-        for i in lst.find_all("li"):
-            user_id = int(i.a["href"].split("=")[-1])
+        # Iterate over all teachers and create user objects
+        for link in _LIST_LINKS_XPATH(tree):
+            user_id = int(link.get("href").rpartition("=")[2])
 
-            user_name = i.a.contents[1].strip()
+            user_name = _TEACHER_NAME_XPATH(link).strip()
 
-            initial_span = i.a.find('span')
+            initial_span = link.find('.//span')
 
             user_initials = None
             if initial_span is not None:
-                user_initials = initial_span.text.strip()
+                user_initials = initial_span.text_content().strip()
 
-            teachers.append(User(self._lectio,
-                                 user_id,
-                                 UserType.TEACHER,
-                                 lazy=True,
-                                 name=user_name,
-                                 initials=user_initials))
+            teacher = User(self._lectio,
+                           user_id,
+                           UserType.TEACHER,
+                           lazy=True,
+                           name=user_name,
+                           initials=user_initials)
+
+            teachers.append(teacher)
+
+            # Indexed from the parsed initials, as ``teacher.initials`` would populate
+            # every teacher without initials in the list
+            if user_initials:
+                teachers_by_initials[user_initials.lower()] = teacher
+
+        return teachers, teachers_by_initials
+
+    def get_teacher_by_initials(self, initials: str) -> Optional[User]:
+        """Get a teacher by their initials
+
+        Note:
+            The lookup uses the cached teacher list, see :meth:`get_teachers`.
+
+        Args:
+            initials (str): Initials of the teacher (case insensitive)
+
+        Returns:
+            :class:`lectio.models.user.User`|None: The teacher, or None if no teacher has those initials
+        """
 
-        return teachers
+        _, teachers_by_initials = self.__cached("teachers", self.__fetch_teachers)
+
+        return teachers_by_initials.get(initials.lower())
 
     def search_for_teachers(self, query_name: str, query_initials: str = None) -> List[User]:
         """Search for teachers by name or initials
@@ -114,15 +198,12 @@ class School:
             list(:class:`lectio.models.user.User`): List of teachers
         """
 
-        res = []
-
-        for teacher in self.get_teachers():
-            if query_initials and query_initials.lower() in teacher.initials.lower():
-                res.append(teacher)
-            elif query_name.lower() in teacher.name.lower():
-                res.append(teacher)
+        query_name = query_name.lower()
+        if query_initials:
+            query_initials = query_initials.lower()
 
-        return res
+        return [teacher for teacher in self.get_teachers()
+                if (query_initials and query_initials in teacher.initials.lower()) or query_name in teacher.name.lower()]
 
     def get_students_by_letter(self, letter: str) -> List[User]:
         """Get students by first letter of name
@@ -132,31 +213,32 @@ class School:
 
         Returns:
             list(:class:`lectio.models.user.User`): List of students
+
+        Note:
+            The list is cached for 5 minutes, see :meth:`clear_cache`.
         """
 
-        r = self._lectio._request(
-            "FindSkema.aspx?type=elev&forbogstav=" + quote(letter.upper()))
+        letter = letter.upper()
 
-        soup = BeautifulSoup(r.text, 'html.parser')
+        return list(self.__cached("students:" + letter, partial(self.__fetch_students_by_letter, letter)))
 
-        students = []
+    def __fetch_students_by_letter(self, letter: str) -> List[User]:
+        r = self._lectio._request(
+            "FindSkema.aspx?type=elev&forbogstav=" + quote(letter))
 
-        # Container containing all students
-        lst = soup.find("ul", {"class": "ls-columnlist mod-onechild"})
+        tree = make_tree(r)
 
-        # Shouldn't happen in cases other than ``len(letter) > 1`` or if letter is not a valid character
-        if lst is None:
-            return []
+        students = []
 
-        # Iterate and create user objects
-        for i in lst.find_all("li"):
-            user_id = int(i.a["href"].split("=")[-1])
+        # Iterate over all students and create user objects.
+        # There is no list for ``len(letter) > 1`` or if letter is not a valid character
+        for link in _LIST_LINKS_XPATH(tree):
+            user_id = int(link.get("href").rpartition("=")[2])
 
-            user_info = i.a.text.strip()
+            user_info = link.text_content().strip()
 
             # Search for name and class
-            search = re.search(
-                r"(?P<name>.*) \((?P<class_name>.*?) \d+?\)", user_info)
+            search = _STUDENT_RE.search(user_info)
 
             if search is None:
                 continue
@@ -165,7 +247,8 @@ class School:
                                  user_id,
                                  lazy=True,
                                  name=search.group("name"),
-                                 class_name=search.group("class_name")))
+                                 # Shared by every student in the class
+                                 class_name=sys.intern(search.group("class_name"))))
 
         return students
 
@@ -185,27 +268,26 @@ class School:
             list(:class:`lectio.User`): List of users
         """
 
-        res = []
-
-        for student in self.get_students_by_letter(query[0]):
-            if query.lower() in student.name.lower():
-                res.append(student)
+        lowered = query.lower()
 
-        return res
+        return [student for student in self.get_students_by_letter(query[0])
+                if lowered in student.name.lower()]
 
-    def get_all_students(self) -> List[User]:
+    def get_all_students(self, max_workers: int = 8) -> List[User]:
         """Get all students
 
+        The student lists for each letter are fetched concurrently.
+
+        Args:
+            max_workers (int): Maximum number of concurrent requests to lectio
+
         Returns:
             list(:class:`User`): List of students
         """
 
-        res = []
-
-        for letter in "abcdefghijklmnopqrstuvwxyzæøå":
-            res.extend(self.get_students_by_letter(letter))
-
-        return res
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(chain.from_iterable(
+                executor.map(self.get_students_by_letter, "abcdefghijklmnopqrstuvwxyzæøå")))
 
     def search_for_users(self, query: str) -> List[User]:
         """Search for user
@@ -217,7 +299,40 @@ class School:
             list(:class:`lectio.models.user.User`): List of users
         """
 
-        return [*self.search_for_students(query), *self.search_for_teachers(query)]
+        lowered = query.lower()
+
+        return [user for user in chain(self.get_students_by_letter(query[0]), self.get_teachers())
+                if lowered in user.name.lower()]
+
+    def get_schedules(self, users: List[User], start_date: 'datetime', end_date: 'datetime', strip_time: bool = True, max_workers: int = 8) -> List[List['Module']]:
+        """Get schedules for multiple users at once
+
+        The schedules are fetched concurrently, which is a lot faster than calling
+        :meth:`lectio.models.user.User.get_schedule` for each user.
+
+        Args:
+            users (list(:class:`lectio.models.user.User`)): Users to get schedules for
+            start_date (:class:`datetime.datetime`): Start date
+            end_date (:class:`datetime.datetime`): End date
+            strip_time (bool): See :meth:`lectio.models.user.User.get_schedule`
+            max_workers (int): Maximum number of concurrent requests to lectio
+
+        Returns:
+            list(list(:class:`lectio.helpers.schedule.Module`)): One schedule per user, in the same order as ``users``
+        """
+
+        return get_schedules(
+            self._lectio,
+            [user._schedule_params() for user in users],
+            start_date,
+            end_date,
+            strip_time,
+            max_workers
+        )
 
     def __repr__(self) -> str:
-        return f"School({self.name})"
+        # Doesn't fetch the name, so repr can't make requests or fail when logged out
+        if self.__name is None:
+            return "School(<not loaded>)"
+
+        return f"School({self.__name})"
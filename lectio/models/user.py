@@ -1,14 +1,24 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from bs4 import BeautifulSoup
-from typing import TYPE_CHECKING, List
+from threading import Lock
+from typing import TYPE_CHECKING, List, Tuple
+
+from lxml import etree
 
 from ..helpers.schedule import get_schedule
+from ..helpers.soup import make_tree
 
 if TYPE_CHECKING:
     from datetime import datetime
     from ..helpers.schedule import Module
     from ..lectio import Lectio
 
+_TITLE_XPATH = etree.XPath("string(//div[@id='s_m_HeaderContent_MainTitle'])", smart_strings=False)
+_IMAGE_XPATH = etree.XPath("//img[@id='s_m_HeaderContent_picctrlthumbimage']/@src", smart_strings=False)
+_STUDENT_TITLE_RE = re.compile(r"(?P<name>.*?), (?P<class_name>.*?)(?: - |, |$)")
+_TEACHER_TITLE_RE = re.compile(r"(?P<initials>.*?) - (?P<name>.*?)(?: - |$)")
+
 
 class UserType(Enum):
     """User types enum
@@ -35,16 +45,20 @@ class UserType(Enum):
             str: String representation of user type
         """
 
-        if self.value == self.STUDENT.value:
-            return "student"
-        elif self.value == self.TEACHER.value:
-            return "teacher"
+        return _USER_TYPE_STR[self]
 
     def __str__(self) -> str:
-        if self.value == self.STUDENT.value:
-            return "elev"
-        elif self.value == self.TEACHER.value:
-            return "laerer"
+        return _USER_TYPE_URL_STR[self]
+
+
+_USER_TYPE_STR = {
+    UserType.STUDENT: "student",
+    UserType.TEACHER: "teacher",
+}
+_USER_TYPE_URL_STR = {
+    UserType.STUDENT: "elev",
+    UserType.TEACHER: "laerer",
+}
 
 
 class User:
@@ -68,10 +82,8 @@ class User:
         type (:class:`lectio.models.user.UserType`): User type (UserType.STUDENT or UserType.TEACHER)
     """
 
-    __name = None
-    __initials = None
-    __class_name = None
-    __image = None
+    __slots__ = ("_lectio", "id", "type", "__name", "__initials",
+                 "__class_name", "__image", "__populated", "__populate_lock")
 
     def __init__(self, lectio: 'Lectio', user_id: int, user_type: UserType = UserType.STUDENT, *, lazy=False, **user_data) -> None:
         self._lectio = lectio
@@ -79,43 +91,75 @@ class User:
 
         self.type = user_type
 
+        self.__name = user_data.get("name")
+        self.__initials = user_data.get("initials")
+        self.__class_name = user_data.get("class_name")
+        self.__image = user_data.get("image")
+
+        self.__populated = False
+        self.__populate_lock = Lock()
+
         if not lazy:
             self.__populate()
-        else:
-            self.__name = user_data.get("name")
-            self.__initials = user_data.get("initials")
-            self.__class_name = user_data.get("class_name")
-            self.__image = user_data.get("image")
 
     def __populate(self) -> None:
         """Populate user object
 
         Populates the user object with data from lectio, such as name, class name, etc.
+        The data is only fetched once, even when populating from multiple threads at once.
         """
 
+        if self.__populated:
+            return
+
+        with self.__populate_lock:
+            if not self.__populated:
+                self.__fetch()
+                self.__populated = True
+
+    def __fetch(self) -> None:
         # TODO; Check if user is student or teacher
 
         # Get user's schedule for today
         r = self._lectio._request(
             f"SkemaNy.aspx?type={self.type}&{self.type}id={self.id}")
 
-        soup = BeautifulSoup(r.text, "html.parser")
+        tree = make_tree(r)
 
-        title = soup.find("div", {"id": "s_m_HeaderContent_MainTitle"}).text
+        title = _TITLE_XPATH(tree)
 
         title = " ".join(title.split()[1:])
 
         if self.type == UserType.STUDENT:
-            self.__name = title.split(", ")[0]
-            self.__class_name = title.split(", ")[1].split(" - ")[0]
+            match = _STUDENT_TITLE_RE.match(title)
+            self.__name = match["name"]
+            self.__class_name = match["class_name"]
         elif self.type == UserType.TEACHER:
-            self.__initials, self.__name, *_ = title.split(" - ")
+            match = _TEACHER_TITLE_RE.match(title)
+            self.__initials = match["initials"]
+            self.__name = match["name"]
 
-        src = soup.find(
-            "img", {"id": "s_m_HeaderContent_picctrlthumbimage"}).get("src")
+        src = _IMAGE_XPATH(tree)[0]
 
         self.__image = f"https://www.lectio.dk{src}&fullsize=1"
 
+    @staticmethod
+    def populate_many(users: List['User'], max_workers: int = 8) -> None:
+        """Populate multiple users at once
+
+        The users are populated concurrently, which is a lot faster than accessing
+        e.g. :attr:`image` on each user one at a time. Users that are already populated are skipped.
+
+        Args:
+            users (list(:class:`lectio.models.user.User`)): Users to populate
+            max_workers (int): Maximum number of concurrent requests to lectio
+        """
+
+        pending = [user for user in users if not user.__populated]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(User.__populate, pending))
+
     def get_schedule(self, start_date: 'datetime', end_date: 'datetime', strip_time: bool = True) -> List['Module']:
         """Get schedule for user
 
@@ -133,12 +177,36 @@ class User:
 
         return get_schedule(
             self._lectio,
-            [f"{self.type.get_str()}sel={self.id}"],
+            self._schedule_params(),
             start_date,
             end_date,
             strip_time
         )
 
+    def get_schedules(self, date_ranges: List[Tuple['datetime', 'datetime']], strip_time: bool = True, max_workers: int = 8) -> List[List['Module']]:
+        """Get schedules for user for multiple time ranges at once
+
+        The schedules are fetched concurrently, which is useful for ranges longer than
+        a month, as each range has to be less than one month (see :meth:`get_schedule`).
+
+        Args:
+            date_ranges (list(tuple(:class:`datetime.datetime`, :class:`datetime.datetime`))): List of ``(start_date, end_date)`` pairs
+            strip_time (bool): See :meth:`get_schedule`
+            max_workers (int): Maximum number of concurrent requests to lectio
+
+        Returns:
+            list(list(:class:`lectio.helpers.schedule.Module`)): One schedule per time range, in the same order as ``date_ranges``
+        """
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(
+                lambda dates: self.get_schedule(*dates, strip_time),
+                date_ranges
+            ))
+
+    def _schedule_params(self) -> List[str]:
+        return [f"{self.type.get_str()}sel={self.id}"]
+
     def __repr__(self) -> str:
         return f"User({self.type.get_str().capitalize()}, {self.id})"
 
@@ -188,9 +256,23 @@ class User:
         if not isinstance(__o, User):
             return False
 
-        return self.id == __o.id and self.type == __o.type
+        # Enum members are singletons, so identity is enough for the type
+        return self.id == __o.id and self.type is __o.type
+
+    def __hash__(self) -> int:
+        return hash((self.id, self.type.value))
+
+    # The populate lock can't be pickled or copied, so it is left out and a new one is made
+    def __getstate__(self) -> tuple:
+        return (self._lectio, self.id, self.type, self.__name, self.__initials,
+                self.__class_name, self.__image, self.__populated)
+
+    def __setstate__(self, state: tuple) -> None:
+        (self._lectio, self.id, self.type, self.__name, self.__initials,
+         self.__class_name, self.__image, self.__populated) = state
+        self.__populate_lock = Lock()
 
 
 class Me(User):
     # TODO: Add methods for getting grades, absences, etc.
-    pass
+    __slots__ = ()
@@ -13,6 +13,11 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/dnorhoj/lectio.py",
     packages=setuptools.find_packages(),
+    install_requires=[
+        "requests",
+        "beautifulsoup4",
+        "lxml",
+    ],
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",